@@ -12,6 +12,9 @@ class Settings(BaseSettings):
     vector_db_path: str = os.getenv("VECTOR_DB_PATH", "./vector_store")
     vector_db_type: str = os.getenv("VECTOR_DB_TYPE", "chromadb")
 
+    # Uploaded documents / chunks database
+    document_db_path: str = os.getenv("DOCUMENT_DB_PATH", "./documents.db")
+
     # PDF upload path
     pdf_upload_path: str = os.getenv("PDF_UPLOAD_PATH", "../data")
 
@@ -20,6 +23,8 @@ class Settings(BaseSettings):
     embedding_num_gpu: int = int(os.getenv("EMBEDDING_NUM_GPU", "1"))
     # get number of threads from environment variable or default to max available
     embedding_num_thread: int = int(os.getenv("EMBEDDING_NUM_THREAD", os.cpu_count()))
+    # number of texts sent to Ollama per embedding request
+    embedding_batch_size: int = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
 
     # LLM configuration
     llm_model: str = os.getenv("LLM_MODEL", "deepseek-r1:7b")
@@ -29,10 +34,16 @@ class Settings(BaseSettings):
     # Chunking configuration
     chunk_size: int = int(os.getenv("CHUNK_SIZE", "1000"))
     chunk_overlap: int = int(os.getenv("CHUNK_OVERLAP", "200"))
+    # chunks shorter than this are merged into a neighbouring chunk
+    min_chunk_size: int = int(os.getenv("MIN_CHUNK_SIZE", "100"))
+    # parent sections returned to the LLM are capped at this many characters
+    parent_chunk_size: int = int(os.getenv("PARENT_CHUNK_SIZE", "4000"))
 
     # Retrieval configuration
     retrieval_k: int = int(os.getenv("RETRIEVAL_K", "5"))
     similarity_threshold: float = float(os.getenv("SIMILARITY_THRESHOLD", "0.3"))
+    # upper bound on the characters of retrieved context sent to the LLM
+    max_context_chars: int = int(os.getenv("MAX_CONTEXT_CHARS", "8000"))
 
     # Server configuration
     host: str = os.getenv("HOST", "0.0.0.0")
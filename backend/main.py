@@ -1,11 +1,13 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
 from models.schemas import (
     DocumentsResponse,
     UploadResponse,
     ChunksResponse,
 )
+from services.document_store import DocumentStore
 from services.pdf_processor import PDFProcessor
 from services.vector_store import VectorStoreService
 from services.rag_pipeline import RAGPipeline
@@ -13,7 +15,6 @@ from config import settings
 import logging
 import time
 import os
-from datetime import datetime
 
 # Configure logging
 logging.basicConfig(level=settings.log_level)
@@ -38,10 +39,7 @@ app.add_middleware(
 pdf_processor = PDFProcessor()
 vector_store = VectorStoreService()
 rag_pipeline = RAGPipeline()
-
-# Track uploaded documents in memory
-documents_info = []
-document_chunks = []
+document_store = DocumentStore()
 
 
 @app.on_event("startup")
@@ -64,28 +62,17 @@ async def upload_pdf(file: UploadFile = File(...)):
     save_path = os.path.join(settings.pdf_upload_path, file.filename)
     os.makedirs(settings.pdf_upload_path, exist_ok=True)
     with open(save_path, "wb") as f:
-        f.write(await file.read())
+        while chunk := await file.read(1 << 20):
+            f.write(chunk)
     start_time = time.time()
-    documents = pdf_processor.process_pdf(save_path)
-    vector_store.add_documents(documents)
+    # PDF processing and embedding block, so keep them off the event loop
+    documents, parents = await run_in_threadpool(pdf_processor.process_pdf, save_path)
+    # Drop vectors from an earlier upload of the same file
+    await run_in_threadpool(vector_store.delete_by_source, file.filename)
+    await run_in_threadpool(vector_store.add_documents, documents)
     processing_time = round(time.time() - start_time, 2)
 
-    doc_info = {
-        "filename": file.filename,
-        "upload_date": datetime.utcnow(),
-        "chunks_count": len(documents),
-        "status": "processed",
-    }
-    documents_info.append(doc_info)
-
-    for idx, doc in enumerate(documents):
-        chunk = {
-            "id": f"{file.filename}-{idx}",
-            "content": doc.page_content,
-            "page": doc.metadata.get("page", 0),
-            "metadata": doc.metadata,
-        }
-        document_chunks.append(chunk)
+    document_store.add_document(file.filename, documents, parents)
     return UploadResponse(
         message="PDF processed and vectorized successfully.",
         filename=file.filename,
@@ -97,7 +84,7 @@ async def upload_pdf(file: UploadFile = File(...)):
 @app.get("/api/documents", response_model=DocumentsResponse)
 async def get_documents():
     """Get list of processed documents"""
-    return DocumentsResponse(documents=documents_info)
+    return DocumentsResponse(documents=document_store.get_documents())
 
 
 @app.post("/api/chat")
@@ -108,17 +95,18 @@ async def chat_endpoint(request: Request):
     if not question:
         return {"error": "Question is required."}
 
-    def answer_stream():
-        for chunk in rag_pipeline.stream_answer(question, chat_history):
-            yield chunk
-
-    return StreamingResponse(answer_stream(), media_type="text/plain")
+    return StreamingResponse(
+        rag_pipeline.stream_answer(question, chat_history), media_type="text/plain"
+    )
 
 
 @app.get("/api/chunks", response_model=ChunksResponse)
-async def get_chunks():
+async def get_chunks(offset: int = Query(0, ge=0), limit: int = Query(100, ge=1)):
     """Get document chunks (optional endpoint)"""
-    return ChunksResponse(chunks=document_chunks, total_count=len(document_chunks))
+    return ChunksResponse(
+        chunks=document_store.get_chunks(offset=offset, limit=limit),
+        total_count=document_store.get_chunk_count(),
+    )
 
 
 if __name__ == "__main__":
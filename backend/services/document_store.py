@@ -0,0 +1,158 @@
+from typing import List, Dict, Any
+from contextlib import contextmanager
+from datetime import datetime
+from langchain.schema import Document
+from config import settings
+import json
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentStore:
+    def __init__(self):
+        """Initialize SQLite store for uploaded documents and their chunks"""
+        self.db_path = settings.document_db_path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS documents (
+                    filename TEXT PRIMARY KEY,
+                    upload_date TEXT NOT NULL,
+                    chunks_count INTEGER NOT NULL,
+                    status TEXT NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS chunks (
+                    id TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    page INTEGER NOT NULL,
+                    content TEXT NOT NULL,
+                    metadata TEXT NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS parents (
+                    id TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    metadata TEXT NOT NULL
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add_document(
+        self,
+        filename: str,
+        documents: List[Document],
+        parents: Dict[str, Document] = None,
+        status: str = "processed",
+    ) -> None:
+        """Record an uploaded document, its chunks and their parent sections,
+        replacing earlier uploads"""
+        parents = parents or {}
+        with self._connect() as conn:
+            conn.execute("DELETE FROM chunks WHERE filename = ?", (filename,))
+            conn.execute("DELETE FROM parents WHERE filename = ?", (filename,))
+            conn.execute(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)",
+                (filename, datetime.utcnow().isoformat(), len(documents), status),
+            )
+            conn.executemany(
+                "INSERT INTO chunks VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        f"{filename}-{idx}",
+                        filename,
+                        doc.metadata.get("page", 0),
+                        doc.page_content,
+                        json.dumps(doc.metadata),
+                    )
+                    for idx, doc in enumerate(documents)
+                ),
+            )
+            conn.executemany(
+                "INSERT INTO parents VALUES (?, ?, ?, ?)",
+                (
+                    (
+                        parent_id,
+                        filename,
+                        doc.page_content,
+                        json.dumps(doc.metadata),
+                    )
+                    for parent_id, doc in parents.items()
+                ),
+            )
+        logger.info(f"Stored {len(documents)} chunks for {filename}.")
+
+    def get_documents(self) -> List[Dict[str, Any]]:
+        """Get list of processed documents"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT filename, upload_date, chunks_count, status "
+                "FROM documents ORDER BY upload_date"
+            ).fetchall()
+        return [
+            {
+                "filename": filename,
+                "upload_date": upload_date,
+                "chunks_count": chunks_count,
+                "status": status,
+            }
+            for filename, upload_date, chunks_count, status in rows
+        ]
+
+    def get_chunks(self, offset: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        """Get a page of document chunks"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, page, content, metadata FROM chunks "
+                "ORDER BY rowid LIMIT ? OFFSET ?",
+                (limit, offset),
+            ).fetchall()
+        return [
+            {
+                "id": chunk_id,
+                "content": content,
+                "page": page,
+                "metadata": json.loads(metadata),
+            }
+            for chunk_id, page, content, metadata in rows
+        ]
+
+    def get_chunk_count(self) -> int:
+        """Get total number of stored chunks"""
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def get_parents(self, parent_ids: List[str]) -> Dict[str, Document]:
+        """Get parent sections by id"""
+        if not parent_ids:
+            return {}
+        placeholders = ", ".join("?" * len(parent_ids))
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, content, metadata FROM parents "
+                f"WHERE id IN ({placeholders})",
+                list(parent_ids),
+            ).fetchall()
+        return {
+            parent_id: Document(page_content=content, metadata=json.loads(metadata))
+            for parent_id, content, metadata in rows
+        }
@@ -1,64 +1,251 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, partial
 import pdfplumber
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
+from semantic_text_splitter import TextSplitter
 from langchain.schema import Document
 from config import settings
 import logging
+import multiprocessing
+import os
 import re
-import nltk
+import threading
+from uuid import uuid4
+
+try:
+    import blingfire
+except ImportError:
+    blingfire = None
 
 logger = logging.getLogger(__name__)
 
-try:
-    nltk.data.find("tokenizers/punkt_tab")
-except LookupError:
-    nltk.download(info_or_id="punkt_tab", quiet=True)
+
+_WS_RE = re.compile(r"\s+")
+# Cells of a table are joined with a NUL separator and cleaned in one pass
+_CELL_SEP = "\x00"
+_CELL_RE = re.compile(r"\$\s+|\s+")
+_JOINED_CELLS_RE = re.compile(r"\s*\x00\s*|\$\s+|\s+")
+_NUMBER_RE = re.compile(r"\d[\d,.]*")
+_HEADING_LINE_RE = re.compile(r"^(\d+\.|[A-Z][A-Z\s\-:]+)$")
+_YEAR_RE = re.compile(r"(20\d{2}|19\d{2})")
+
+_FINANCIAL_HEADINGS = (
+    "income statement",
+    "profit and loss",
+    "p&l",
+    "balance sheet",
+    "statement of financial position",
+    "cash flow statement",
+    "statement of cash flows",
+    "revenue",
+    "cost of goods sold",
+    "operating expenses",
+    "assets",
+    "liabilities",
+    "equity",
+    "shareholders' equity",
+    "total revenue",
+    "gross profit",
+    "operating income",
+    "net income",
+    "cash and cash equivalents",
+)
+
+_METRICS = (
+    "revenue",
+    "operating profit",
+    "operating income",
+    "net income",
+    "gross profit",
+    "cash flow",
+    "debt",
+    "cost of goods sold",
+    "expenses",
+    "liabilities",
+    "assets",
+    "equity",
+)
+
+
+def _compile_alternation(terms) -> re.Pattern:
+    """Build a single case-insensitive pattern matching any of the terms"""
+    ordered = sorted(terms, key=len, reverse=True)
+    return re.compile("|".join(map(re.escape, ordered)), re.IGNORECASE)
+
+
+_FINANCIAL_HEADING_RE = _compile_alternation(_FINANCIAL_HEADINGS)
+_METRIC_RE = _compile_alternation(_METRICS)
+
+
+@lru_cache(maxsize=None)
+def _load_nltk():
+    """Import nltk and fetch the Punkt model on first use"""
+    import nltk
+
+    try:
+        nltk.data.find("tokenizers/punkt_tab")
+    except LookupError:
+        nltk.download(info_or_id="punkt_tab", quiet=True)
+    return nltk
+
+
+def _sent_tokenize(text: str) -> List[str]:
+    """Split text into sentences, preferring blingfire over nltk's Punkt"""
+    if blingfire is not None:
+        return [s for s in blingfire.text_to_sentences(text).split("\n") if s]
+    return _load_nltk().sent_tokenize(text)
+
+
+def _clean_cell_match(match: re.Match) -> str:
+    token = match.group(0)
+    if _CELL_SEP in token:
+        return _CELL_SEP
+    return "$" if token[0] == "$" else " "
+
+
+def _clean_cell(cell) -> str:
+    """Squeeze whitespace and drop spaces after "$" in a single pass"""
+    if cell is None:
+        return ""
+    return _CELL_RE.sub(_clean_cell_match, str(cell)).strip()
+
+
+def _clean_rows(rows: List[List[Any]]) -> List[List[str]]:
+    """Clean all cells of a table with a single regex pass over the joined cells"""
+    cells = ["" if cell is None else str(cell) for row in rows for cell in row]
+    joined = _CELL_SEP.join(cells)
+    if joined.count(_CELL_SEP) != len(cells) - 1:
+        # A cell contains the separator itself; clean cell by cell instead
+        return [[_clean_cell(cell) for cell in row] for row in rows]
+    cleaned = _JOINED_CELLS_RE.sub(_clean_cell_match, joined).strip().split(_CELL_SEP)
+    result = []
+    start = 0
+    for row in rows:
+        result.append(cleaned[start : start + len(row)])
+        start += len(row)
+    return result
+
+
+# PDFs with fewer pages than this are extracted in-process
+_PARALLEL_MIN_PAGES = 8
+_executor = None
+# pdfium is not thread-safe; serializes its use within this process
+_pdfium_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """Shared page-extraction pool, created on first use. Workers are spawned
+    rather than forked, since the server process runs threads of its own."""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=os.cpu_count() or 1,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+def _reset_executor() -> None:
+    """Drop a broken pool so the next upload starts a fresh one"""
+    global _executor
+    _executor = None
+
+
+def _needs_tables(text: str) -> bool:
+    """Cheap check whether a page may contain a financial table"""
+    if "$" in text:
+        return True
+    return len(_NUMBER_RE.findall(text)) >= 10
+
+
+def _extract_one_page(file_path: str, page_index: int) -> Dict[str, Any]:
+    """Extract text and tables from a single page (runs in a worker process)"""
+    metadata = {"page": page_index + 1, "source": os.path.basename(file_path)}
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        page = pdf[page_index]
+        textpage = page.get_textpage()
+        has_text = textpage.count_chars() > 0
+        text = textpage.get_text_range() if has_text else ""
+        if not has_text:
+            # Scanned or blank page: skip layout and table analysis entirely
+            has_image = any(
+                True for _ in page.get_objects(filter=[pdfium_c.FPDF_PAGEOBJ_IMAGE])
+            )
+            metadata["skipped"] = "image_only" if has_image else "empty"
+        textpage.close()
+        page.close()
+    finally:
+        pdf.close()
+    if not has_text:
+        return {
+            "page": page_index + 1,
+            "content": "",
+            "tables": [],
+            "metadata": metadata,
+        }
+    text = _WS_RE.sub(" ", text)
+    table_chunks = []
+    if _needs_tables(text):
+        with pdfplumber.open(file_path, pages=[page_index + 1]) as plumber_pdf:
+            table_chunks = PDFProcessor._extract_financial_tables(
+                plumber_pdf.pages[0]
+            )
+    return {
+        "page": page_index + 1,
+        "content": text,
+        "tables": table_chunks,
+        "metadata": metadata,
+    }
 
 
 class PDFProcessor:
     def __init__(self):
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=settings.chunk_size,
-            chunk_overlap=settings.chunk_overlap,
-            separators=["\n\n", "\n", ". ", "! ", "? ", ", ", " ", ""],
+        self.text_splitter = TextSplitter(
+            settings.chunk_size, overlap=settings.chunk_overlap
         )
 
     def extract_text_from_pdf(self, file_path: str) -> List[Dict[str, Any]]:
         logger.info(f"Extracting text from PDF: {file_path}")
-        pages_content = []
-        with pdfplumber.open(file_path) as pdf:
-            for i, page in enumerate(pdf.pages):
-                text = page.extract_text() or ""
-                text = re.sub(r"\s+", " ", text)
-                table_chunks = self._extract_financial_tables(page)
-                pages_content.append(
-                    {
-                        "page": i + 1,
-                        "content": text,
-                        "tables": table_chunks,
-                        "metadata": {"page": i + 1},
-                    }
+        with _pdfium_lock:
+            pdf = pdfium.PdfDocument(file_path)
+            num_pages = len(pdf)
+            pdf.close()
+        if num_pages == 0:
+            return []
+        extract_page = partial(_extract_one_page, file_path)
+        if num_pages < _PARALLEL_MIN_PAGES:
+            with _pdfium_lock:
+                pages_content = [extract_page(i) for i in range(num_pages)]
+        else:
+            try:
+                pages_content = list(
+                    _get_executor().map(extract_page, range(num_pages), chunksize=4)
                 )
+            except BrokenProcessPool:
+                _reset_executor()
+                raise
+        pages_content.sort(key=lambda p: p["page"])
         logger.info(f"Extracted {len(pages_content)} pages from PDF.")
         return pages_content
 
+    def _is_heading(self, line: str) -> bool:
+        return bool(
+            _HEADING_LINE_RE.match(line)
+            or self._is_financial_heading(line)
+            or (len(line) > 0 and line.isupper() and len(line.split()) <= 8)
+        )
+
     def _split_by_headings(self, text: str) -> List[str]:
         lines = text.split("\n")
         chunks = []
         current_chunk = []
         for line in lines:
             line_stripped = line.strip()
-            is_heading = (
-                re.match(r"^(\d+\.|[A-Z][A-Z\s\-:]+)$", line_stripped)
-                or self._is_financial_heading(line_stripped)
-                or (
-                    len(line_stripped) > 0
-                    and line_stripped.isupper()
-                    and len(line_stripped.split()) <= 8
-                )
-            )
-
-            if is_heading:
+            if self._is_heading(line_stripped):
                 if current_chunk:
                     chunks.append(" ".join(current_chunk).strip())
                     current_chunk = []
@@ -69,26 +256,49 @@ class PDFProcessor:
             chunks.append(" ".join(current_chunk).strip())
         return [c for c in chunks if c.strip()]
 
-    def split_into_chunks(self, pages_content: List[Dict[str, Any]]) -> List[Document]:
+    def _group_sections(self, chunks: List[str]) -> List[List[Tuple[int, str]]]:
+        """Group heading chunks into sections of headings followed by their body"""
+        sections = []
+        current = []
+        has_body = False
+        for idx, chunk in enumerate(chunks):
+            is_heading = self._is_heading(chunk)
+            if is_heading and has_body:
+                sections.append(current)
+                current = []
+                has_body = False
+            current.append((idx, chunk))
+            has_body = has_body or not is_heading
+        if current:
+            sections.append(current)
+        return sections
+
+    def split_into_chunks(
+        self, pages_content: List[Dict[str, Any]]
+    ) -> Tuple[List[Document], Dict[str, Document]]:
+        """Split pages into small child chunks for retrieval, each pointing to
+        the parent section it belongs to"""
         logger.info("Splitting pages into smarter chunks...")
         documents = []
+        parents = {}
         for page in pages_content:
             content = page["content"]
             metadata = page.get("metadata", {})
             tables = page.get("tables", [])
             heading_chunks = self._split_by_headings(content)
-            heading_indices = []
-            for idx, chunk in enumerate(heading_chunks):
-                if self._is_financial_heading(chunk):
-                    heading_indices.append(idx)
+            context_heading = None
+            if tables:
+                context_heading = next(
+                    (
+                        h
+                        for h in reversed(heading_chunks)
+                        if self._is_financial_heading(h)
+                    ),
+                    None,
+                )
             for table_str in tables:
                 doc_metadata = dict(metadata)
                 doc_metadata["chunk_type"] = "table"
-                context_heading = None
-                for idx in reversed(range(len(heading_chunks))):
-                    if self._is_financial_heading(heading_chunks[idx]):
-                        context_heading = heading_chunks[idx]
-                        break
                 year = self._extract_year(table_str) or (
                     context_heading and self._extract_year(context_heading)
                 )
@@ -106,52 +316,145 @@ class PDFProcessor:
                 documents.append(
                     Document(page_content=page_content, metadata=doc_metadata)
                 )
-            for idx, chunk in enumerate(heading_chunks):
-                doc_metadata = dict(metadata)
-                doc_metadata["chunk_type"] = "heading"
-                doc_metadata["chunk_index"] = idx
-                year = self._extract_year(chunk)
-                metric = self._extract_metric_type(chunk)
-                if year:
-                    doc_metadata["year"] = year
-                if metric:
-                    doc_metadata["metric_type"] = metric
-                if len(chunk) > settings.chunk_size * 2:
-                    sentences = nltk.sent_tokenize(chunk)
-                    temp = []
-                    for sent in sentences:
-                        temp.append(sent)
-                        if sum(len(s) for s in temp) > settings.chunk_size:
-                            doc_metadata_sent = dict(doc_metadata)
-                            documents.append(
-                                Document(
-                                    page_content=" ".join(temp),
-                                    metadata=doc_metadata_sent,
-                                )
-                            )
-                            temp = []
-                    if temp:
-                        doc_metadata_sent = dict(doc_metadata)
+            for section in self._group_sections(heading_chunks):
+                children = []
+                for idx, chunk in section:
+                    doc_metadata = dict(metadata)
+                    doc_metadata["chunk_type"] = "heading"
+                    doc_metadata["chunk_index"] = idx
+                    year = self._extract_year(chunk)
+                    metric = self._extract_metric_type(chunk)
+                    if year:
+                        doc_metadata["year"] = year
+                    if metric:
+                        doc_metadata["metric_type"] = metric
+                    children.extend(
+                        (text, doc_metadata) for text in self._split_sentences(chunk)
+                    )
+                for group in self._group_parents(children):
+                    parent_id = str(uuid4())
+                    parent_metadata = dict(metadata)
+                    parent_metadata["chunk_type"] = "parent"
+                    parents[parent_id] = Document(
+                        page_content="\n".join(text for text, _ in group),
+                        metadata=parent_metadata,
+                    )
+                    for text, doc_metadata in group:
                         documents.append(
                             Document(
-                                page_content=" ".join(temp), metadata=doc_metadata_sent
+                                page_content=text,
+                                metadata=dict(doc_metadata, parent_id=parent_id),
                             )
                         )
-                else:
-                    documents.append(
-                        Document(page_content=chunk, metadata=doc_metadata)
-                    )
-        logger.info(f"Total chunks created: {len(documents)}")
-        return documents
+        documents = self._merge_small_chunks(self._split_oversized(documents))
+        logger.info(
+            f"Total chunks created: {len(documents)} ({len(parents)} parent sections)"
+        )
+        return documents, parents
+
+    def _split_sentences(self, chunk: str) -> List[str]:
+        """Split an oversized heading chunk into roughly chunk_size pieces"""
+        if len(chunk) <= settings.chunk_size * 2:
+            return [chunk]
+        pieces = []
+        temp = []
+        temp_len = 0
+        for sent in _sent_tokenize(chunk):
+            if temp and temp_len + len(sent) > settings.chunk_size:
+                pieces.append(" ".join(temp))
+                temp = []
+                temp_len = 0
+            temp.append(sent)
+            temp_len += len(sent) + 1
+        if temp:
+            pieces.append(" ".join(temp))
+        return pieces
+
+    def _group_parents(
+        self, children: List[Tuple[str, Dict[str, Any]]]
+    ) -> List[List[Tuple[str, Dict[str, Any]]]]:
+        """Group consecutive children of a section into parents of at most
+        parent_chunk_size characters"""
+        groups = []
+        current = []
+        current_len = 0
+        for child in children:
+            if current and current_len + len(child[0]) > settings.parent_chunk_size:
+                groups.append(current)
+                current = []
+                current_len = 0
+            current.append(child)
+            current_len += len(child[0]) + 1
+        if current:
+            groups.append(current)
+        return groups
+
+    def _can_merge(self, first: Document, second: Document) -> bool:
+        # Tables stay whole so each keeps its own header row and metadata
+        if "table" in (
+            first.metadata.get("chunk_type"),
+            second.metadata.get("chunk_type"),
+        ):
+            return False
+        if (
+            len(first.page_content) >= settings.min_chunk_size
+            and len(second.page_content) >= settings.min_chunk_size
+        ):
+            return False
+        if len(first.page_content) + len(second.page_content) >= settings.chunk_size:
+            return False
+        return all(
+            first.metadata.get(key) == second.metadata.get(key)
+            for key in ("page", "chunk_type", "parent_id")
+        )
 
-    def process_pdf(self, file_path: str) -> List[Document]:
+    def _merge_small_chunks(self, documents: List[Document]) -> List[Document]:
+        """Merge tiny chunks (e.g. a lone heading) into their neighbour"""
+        merged = []
+        buf = None
+        for doc in documents:
+            if buf is not None and self._can_merge(buf, doc):
+                metadata = dict(doc.metadata)
+                metadata.update(buf.metadata)
+                buf = Document(
+                    page_content=f"{buf.page_content}\n{doc.page_content}",
+                    metadata=metadata,
+                )
+                continue
+            if buf is not None:
+                merged.append(buf)
+            buf = doc
+        if buf is not None:
+            merged.append(buf)
+        return merged
+
+    def _split_oversized(self, documents: List[Document]) -> List[Document]:
+        """Re-split text chunks that are still larger than the chunk size"""
+        result = []
+        for doc in documents:
+            if (
+                len(doc.page_content) <= settings.chunk_size
+                or doc.metadata.get("chunk_type") == "table"
+            ):
+                result.append(doc)
+                continue
+            result.extend(
+                Document(page_content=text, metadata=doc.metadata)
+                for text in self.text_splitter.chunks(doc.page_content)
+            )
+        return result
+
+    def process_pdf(
+        self, file_path: str
+    ) -> Tuple[List[Document], Dict[str, Document]]:
         logger.info(f"Starting PDF processing pipeline for: {file_path}")
         pages_content = self.extract_text_from_pdf(file_path)
-        documents = self.split_into_chunks(pages_content)
+        documents, parents = self.split_into_chunks(pages_content)
         logger.info(f"PDF processing complete. Total chunks: {len(documents)}")
-        return documents
+        return documents, parents
 
-    def _extract_financial_tables(self, page) -> List[str]:
+    @staticmethod
+    def _extract_financial_tables(page) -> List[str]:
         """Enhanced table extraction specifically for financial data"""
         table_chunks = []
         tables = page.extract_tables() or []
@@ -160,35 +463,20 @@ class PDFProcessor:
             if not table:
                 continue
 
-            cleaned_rows = []
-            for row in table:
-                if not any(row):
-                    continue
-
-                cleaned_row = []
-                for cell in row:
-                    if cell is None:
-                        cleaned_row.append("")
-                    else:
-                        cell_str = str(cell).strip()
-                        cell_str = re.sub(r"\$\s+", "$", cell_str)
-                        cell_str = re.sub(r"\s+", " ", cell_str)
-                        cleaned_row.append(cell_str)
-                cleaned_rows.append(cleaned_row)
+            cleaned_rows = _clean_rows([row for row in table if any(row)])
 
             if cleaned_rows:
                 table_str = []
-                headers = cleaned_rows[0] if cleaned_rows else []
+                headers = cleaned_rows[0]
 
-                if headers and any(headers):
-                    table_str.append("| " + " | ".join(headers) + " |")
-                    table_str.append(
-                        "|" + "|".join(["-" * (len(h) + 2) for h in headers]) + "|"
-                    )
+                if any(headers):
+                    divider = "|".join("-" * (len(h) + 2) for h in headers)
+                    table_str = [f"| {' | '.join(headers)} |", f"|{divider}|"]
 
-                for row in cleaned_rows[1:]:
-                    if any(row):
-                        table_str.append("| " + " | ".join(row) + " |")
+                # Rows of whitespace-only cells are only empty after cleaning
+                table_str.extend(
+                    f"| {' | '.join(row)} |" for row in cleaned_rows[1:] if any(row)
+                )
 
                 if table_str:
                     table_chunks.append("\n".join(table_str))
@@ -197,54 +485,14 @@ class PDFProcessor:
 
     def _is_financial_heading(self, text: str) -> bool:
         """Identify financial statement headings"""
-        financial_headings = [
-            "income statement",
-            "profit and loss",
-            "p&l",
-            "balance sheet",
-            "statement of financial position",
-            "cash flow statement",
-            "statement of cash flows",
-            "revenue",
-            "cost of goods sold",
-            "operating expenses",
-            "assets",
-            "liabilities",
-            "equity",
-            "shareholders' equity",
-            "total revenue",
-            "gross profit",
-            "operating income",
-            "net income",
-            "cash and cash equivalents",
-        ]
-
-        text_lower = text.lower().strip()
-        return any(heading in text_lower for heading in financial_headings)
+        return bool(_FINANCIAL_HEADING_RE.search(text))
 
     def _extract_year(self, text: str) -> str:
         """Extracts a 4-digit year from text, prioritizing 20xx/19xx."""
-        match = re.search(r"(20\d{2}|19\d{2})", text)
+        match = _YEAR_RE.search(text)
         return match.group(1) if match else None
 
     def _extract_metric_type(self, text: str) -> str:
         """Extracts a financial metric type from text if present."""
-        metrics = [
-            "revenue",
-            "operating profit",
-            "operating income",
-            "net income",
-            "gross profit",
-            "cash flow",
-            "debt",
-            "cost of goods sold",
-            "expenses",
-            "liabilities",
-            "assets",
-            "equity",
-        ]
-        text_lower = text.lower()
-        for metric in metrics:
-            if metric in text_lower:
-                return metric
-        return None
+        match = _METRIC_RE.search(text)
+        return match.group(0).lower() if match else None
@@ -1,28 +1,102 @@
 import re
 import json
+import asyncio
+import random
 from typing import List, Dict, Any, Tuple
 from langchain.schema import Document
+from services.document_store import DocumentStore
 from services.vector_store import VectorStoreService
 from config import settings
 import logging
 import time
-from ollama import Client, generate
+import httpx
+from ollama import Client
 
 logger = logging.getLogger(__name__)
 
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+
+def _partial_tag_len(text: str, tag: str) -> int:
+    """Length of the longest suffix of text that is a proper prefix of tag"""
+    for n in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:n]):
+            return n
+    return 0
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Only connection problems, 429 and 5xx responses are worth retrying"""
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def _error_reason(response: httpx.Response) -> str:
+    """Ollama's error message from a failed response, falling back to the body"""
+    try:
+        data = response.json()
+    except ValueError:
+        return response.text
+    if isinstance(data, dict) and "error" in data:
+        return str(data["error"])
+    return response.text
+
+
+class ThinkBlockFilter:
+    """Strips <think>...</think> blocks from a token stream, even when tags
+    are split across token boundaries"""
+
+    def __init__(self):
+        self.inside_think = False
+        self.pending = ""
+
+    def feed(self, token: str) -> str:
+        text = self.pending + token
+        self.pending = ""
+        output = []
+        while text:
+            tag = THINK_CLOSE if self.inside_think else THINK_OPEN
+            idx = text.find(tag)
+            if idx >= 0:
+                if not self.inside_think:
+                    output.append(text[:idx])
+                text = text[idx + len(tag) :]
+                self.inside_think = not self.inside_think
+                continue
+            keep = _partial_tag_len(text, tag)
+            if not self.inside_think:
+                output.append(text[: len(text) - keep])
+            self.pending = text[len(text) - keep :]
+            break
+        return "".join(output)
+
+    def flush(self) -> str:
+        text = "" if self.inside_think else self.pending
+        self.pending = ""
+        return text
+
 
 class RAGPipeline:
     def __init__(self):
         self.vector_store = VectorStoreService()
+        self.document_store = DocumentStore()
         self.llm_model = settings.llm_model
         self.llm_temperature = settings.llm_temperature
         self.max_tokens = settings.max_tokens
         self.similarity_threshold = settings.similarity_threshold
         self.retrieval_k = settings.retrieval_k
+        self.max_context_chars = settings.max_context_chars
         self.ollama_server_url = settings.ollama_server_url
         self.ollama_client = Client(
             host=self.ollama_server_url,
         )
+        self.http_client = httpx.AsyncClient(
+            base_url=self.ollama_server_url,
+            timeout=httpx.Timeout(10.0, read=None),
+        )
 
     def generate_answer(
         self, question: str, chat_history: List[Dict[str, str]] = None
@@ -54,14 +128,47 @@ class RAGPipeline:
         filtered = [
             (doc, score) for doc, score in results if score >= self.similarity_threshold
         ]
-        return filtered
+        return self._expand_to_parents(filtered)
+
+    def _expand_to_parents(
+        self, docs_with_scores: List[Tuple[Document, float]]
+    ) -> List[Tuple[Document, float]]:
+        """Replace child chunks with their parent section, once per parent,
+        keeping the total context within max_context_chars"""
+        parent_ids = {
+            doc.metadata["parent_id"]
+            for doc, _ in docs_with_scores
+            if doc.metadata and doc.metadata.get("parent_id")
+        }
+        parents = self.document_store.get_parents(list(parent_ids))
+        expanded = []
+        seen = set()
+        total = 0
+        for doc, score in docs_with_scores:
+            parent_id = (doc.metadata or {}).get("parent_id")
+            if parent_id in seen:
+                continue
+            candidates = [doc]
+            if parent_id in parents:
+                candidates.insert(0, parents[parent_id])
+            for candidate in candidates:
+                size = len(candidate.page_content)
+                if not expanded or total + size <= self.max_context_chars:
+                    if candidate is not doc:
+                        seen.add(parent_id)
+                    expanded.append((candidate, score))
+                    total += size
+                    break
+        return expanded
 
     def _generate_context(self, documents: List[Document]) -> str:
         return "\n\n".join([doc.page_content for doc in documents])
 
-    def stream_answer(self, question: str, chat_history: List[Dict[str, str]] = None):
+    async def stream_answer(
+        self, question: str, chat_history: List[Dict[str, str]] = None
+    ):
         start_time = time.time()
-        docs_with_scores = self._retrieve_documents(question)
+        docs_with_scores = await asyncio.to_thread(self._retrieve_documents, question)
         context = self._generate_context([doc for doc, score in docs_with_scores])
         sources = []
         for doc, score in docs_with_scores:
@@ -76,56 +183,50 @@ class RAGPipeline:
             )
         prompt = f"You are a expert financial assistant. Use all your ability to provide best answer the question.\n\nContext:\n{context}\n\nQuestion: {question}\nAnswer:"
         max_retries = 5
+        error = None
         for attempt in range(max_retries):
             try:
-                response = generate(
-                    model=self.llm_model,
-                    prompt=prompt,
-                    stream=True,
-                    options={
+                payload = {
+                    "model": self.llm_model,
+                    "prompt": prompt,
+                    "stream": True,
+                    "options": {
                         "num_ctx": 4096,
                         "temperature": self.llm_temperature,
                         "max_tokens": self.max_tokens,
                     },
-                )
+                }
                 answer = ""
-                inside_think_block = False
-                think_buffer = ""
-
-                for chunk in response:
-                    if isinstance(chunk, dict) and "response" in chunk:
-                        token = chunk["response"]
-                    elif hasattr(chunk, "response"):
-                        token = chunk.response
-                    else:
-                        logger.warning(
-                            f"Unexpected chunk format: {type(chunk)} - {chunk}"
+                think_filter = ThinkBlockFilter()
+
+                async with self.http_client.stream(
+                    "POST", "/api/generate", json=payload
+                ) as response:
+                    if response.is_error:
+                        await response.aread()
+                        raise httpx.HTTPStatusError(
+                            f"{response.status_code}: {_error_reason(response)}",
+                            request=response.request,
+                            response=response,
                         )
-                        continue
-
-                    if "<think>" in token:
-                        inside_think_block = True
-                        before_think = token.split("<think>")[0]
-                        if before_think:
-                            answer += before_think
-                            yield before_think
-                        continue
-
-                    if inside_think_block:
-                        think_buffer += token
-                        if "</think>" in think_buffer:
-                            after_think = think_buffer.split("</think>", 1)
-                            if len(after_think) > 1 and after_think[1]:
-                                clean_token = after_think[1]
-                                answer += clean_token
-                                yield clean_token
-                            inside_think_block = False
-                            think_buffer = ""
-                        continue
-
-                    if token:
-                        answer += token
-                        yield token
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        if "error" in chunk:
+                            raise RuntimeError(chunk["error"])
+                        if "response" not in chunk:
+                            logger.warning(f"Unexpected chunk format: {chunk}")
+                            continue
+                        clean_token = think_filter.feed(chunk["response"])
+                        if clean_token:
+                            answer += clean_token
+                            yield clean_token
+
+                clean_token = think_filter.flush()
+                if clean_token:
+                    answer += clean_token
+                    yield clean_token
 
                 processing_time = round(time.time() - start_time, 2)
                 meta = json.dumps(
@@ -135,5 +236,9 @@ class RAGPipeline:
                 return
             except Exception as e:
                 logger.error(f"Ollama LLM request failed (attempt {attempt + 1}): {e}")
-                time.sleep(2)
-        yield "[Error: LLM service unavailable or returned no answer]"
+                error = e
+                # Retrying after tokens were streamed would duplicate the answer
+                if answer or not _is_retryable(e) or attempt == max_retries - 1:
+                    break
+                await asyncio.sleep(min(30, 2**attempt + random.random() * 0.5))
+        yield f"[Error: LLM request failed: {error}]"
@@ -1,31 +1,155 @@
 from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from uuid import uuid4
 from langchain.schema import Document
 from config import settings
 import logging
 
 # Chroma and Embeddings imports
+import chromadb
+from chromadb.errors import NotFoundError
 from langchain_community.vectorstores import Chroma
-from langchain.embeddings import OllamaEmbeddings
+from langchain_core.embeddings import Embeddings
+from ollama import Client
 
 logger = logging.getLogger(__name__)
 
+# HNSW index parameters applied to the Chroma collection
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64,
+}
+
+
+class OllamaBatchEmbeddings(Embeddings):
+    """Ollama embeddings that send a whole batch of texts per request"""
+
+    def __init__(self):
+        self.client = Client(host=settings.ollama_server_url)
+        self.model = settings.embedding_model
+        self.batch_size = settings.embedding_batch_size
+        # Ollama can serve several embedding requests in parallel per GPU
+        self.max_workers = max(1, settings.embedding_num_gpu * 2)
+        self.options = {
+            "num_gpu": settings.embedding_num_gpu,
+            "num_thread": settings.embedding_num_thread,
+        }
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        response = self.client.embed(
+            model=self.model, input=texts, options=self.options
+        )
+        return [list(embedding) for embedding in response.embeddings]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        batches = [
+            texts[i : i + self.batch_size]
+            for i in range(0, len(texts), self.batch_size)
+        ]
+        if len(batches) <= 1 or self.max_workers == 1:
+            return [emb for batch in batches for emb in self._embed(batch)]
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(batches))
+        ) as executor:
+            results = list(executor.map(self._embed, batches))
+        return [emb for batch in results for emb in batch]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0]
+
 
 class VectorStoreService:
     def __init__(self):
         """Initialize vector store service"""
-        self.embeddings = OllamaEmbeddings(
-            base_url=settings.ollama_server_url,
-            model=settings.embedding_model,
-            num_gpu=settings.embedding_num_gpu,
-            num_thread=settings.embedding_num_thread,
-            show_progress=True,
-        )
+        self.embeddings = OllamaBatchEmbeddings()
         """Initialize Chroma vector store"""
+        client = chromadb.PersistentClient(path=settings.vector_db_path)
+        name = Chroma._LANGCHAIN_DEFAULT_COLLECTION_NAME
+        try:
+            client.get_collection(name)
+        except (ValueError, NotFoundError):
+            # New store: create the collection with the HNSW settings up front
+            self.vectordb = Chroma(
+                client=client,
+                collection_name=name,
+                persist_directory=settings.vector_db_path,
+                embedding_function=self.embeddings,
+                collection_metadata=HNSW_METADATA,
+            )
+        else:
+            self._reopen(client, name)
+            current = self.vectordb._collection.metadata or {}
+            if any(current.get(key) != value for key, value in HNSW_METADATA.items()):
+                self._migrate_to_hnsw()
+        # Cache query embeddings so repeated questions skip the Ollama round trip
+        self._embed_query_cached = lru_cache(maxsize=1024)(self._embed_query)
+
+    def _embed_query(self, text: str) -> Tuple[float, ...]:
+        return tuple(self.embeddings.embed_query(text))
+
+    def _migrate_to_hnsw(self) -> None:
+        """Re-create the collection with tuned HNSW parameters, keeping its data.
+        The data is copied into a temporary collection before the old one is
+        dropped, so the store always has a complete copy."""
+        client = self.vectordb._client
+        collection = self.vectordb._collection
+        name = collection.name
+        tmp_name = f"{name}_hnsw_migration"
+        try:
+            leftover = client.get_collection(tmp_name)
+        except (ValueError, NotFoundError):
+            leftover = None
+        if leftover is not None and collection.count() == 0:
+            # An earlier migration dropped the old collection but was
+            # interrupted before the rename; the copy is complete
+            logger.info("Resuming interrupted vector store migration...")
+            client.delete_collection(name)
+            leftover.modify(name=name)
+            self._reopen(client, name)
+            return
+        if leftover is not None:
+            client.delete_collection(tmp_name)
+
+        existing = collection.get(include=["documents", "metadatas", "embeddings"])
+        logger.info(
+            f"Re-creating vector store collection with HNSW parameters "
+            f"({len(existing['ids'])} documents)..."
+        )
+        migrated = client.create_collection(name=tmp_name, metadata=HNSW_METADATA)
+        if existing["ids"]:
+            self._insert(
+                migrated,
+                existing["ids"],
+                existing["documents"],
+                existing["metadatas"],
+                [embedding.tolist() for embedding in existing["embeddings"]],
+            )
+        client.delete_collection(name)
+        migrated.modify(name=name)
+        self._reopen(client, name)
+
+    def _reopen(self, client, name: str) -> None:
         self.vectordb = Chroma(
+            client=client,
+            collection_name=name,
             persist_directory=settings.vector_db_path,
             embedding_function=self.embeddings,
         )
 
+    def _insert(self, collection, ids, texts, metadatas, embeddings) -> None:
+        """Insert precomputed embeddings into a collection in batches"""
+        max_batch_size = self.vectordb._client.get_max_batch_size()
+        for i in range(0, len(ids), max_batch_size):
+            collection.add(
+                ids=ids[i : i + max_batch_size],
+                documents=texts[i : i + max_batch_size],
+                metadatas=metadatas[i : i + max_batch_size],
+                embeddings=embeddings[i : i + max_batch_size],
+            )
+
     def add_documents(self, documents: List[Document]) -> None:
         """Add documents to the vector store"""
         import time
@@ -35,11 +159,11 @@ class VectorStoreService:
             return
         logger.info(f"Adding {len(documents)} documents to vector store...")
         start = time.time()
-        batch_size = 100
-        for i in range(0, len(documents), batch_size):
-            batch = documents[i : i + batch_size]
-            self.vectordb.add_documents(batch)
-            logger.info(f"Inserted batch {i // batch_size + 1} ({len(batch)} docs)")
+        texts = [doc.page_content for doc in documents]
+        metadatas = [doc.metadata for doc in documents]
+        embeddings = self.embeddings.embed_documents(texts)
+        ids = [str(uuid4()) for _ in texts]
+        self._insert(self.vectordb._collection, ids, texts, metadatas, embeddings)
         self.vectordb.persist()
         elapsed = round(time.time() - start, 2)
         logger.info(
@@ -49,10 +173,14 @@ class VectorStoreService:
     def similarity_search(
         self, query: str, k: int = None
     ) -> List[Tuple[Document, float]]:
-        """Search for similar documents"""
+        """Search for similar documents, scored by cosine similarity"""
         k = k or settings.retrieval_k
-        results = self.vectordb.similarity_search_with_score(query, k=k)
-        return results
+        embedding = self._embed_query_cached(query)
+        results = self.vectordb.similarity_search_by_vector_with_relevance_scores(
+            list(embedding), k=k
+        )
+        # Chroma returns cosine distances, where lower means closer
+        return [(doc, 1.0 - distance) for doc, distance in results]
 
     def delete_documents(self, document_ids: List[str]) -> None:
         """Delete documents from vector store"""
@@ -60,6 +188,12 @@ class VectorStoreService:
         self.vectordb.persist()
         logger.info(f"Deleted {len(document_ids)} documents from vector store.")
 
+    def delete_by_source(self, filename: str) -> None:
+        """Delete all chunks of an uploaded file from vector store"""
+        self.vectordb._collection.delete(where={"source": filename})
+        self.vectordb.persist()
+        logger.info(f"Deleted existing chunks of {filename} from vector store.")
+
     def get_document_count(self) -> int:
         """Get total number of documents in vector store"""
         return self.vectordb._collection.count()